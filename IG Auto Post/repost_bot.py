@@ -9,20 +9,251 @@ import shutil
 import schedule
 import urllib.parse
 import requests
+import cProfile
+import tracemalloc
+import functools
+from contextlib import contextmanager
 from upload_post import UploadPostClient
 
 load_dotenv()
 
+def fsync_directory(path):
+    """Fsync the directory containing path so a rename into it is durable"""
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def replace_file_atomically(path, write):
+    """Write a file via temp file + fsync + os.replace so it is never left half-written"""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    fsync_directory(path)
+
+class RepostJournal:
+    """Append-only journal of per-shortcode lifecycle transitions.
+
+    Each line is a JSON record like {"key": ..., "state": ..., "video": ..., "ts": ...}.
+    Every write is flushed to the OS but fsynced in batches; transitions that
+    must survive a power loss (a download's path, a confirmed upload) force an
+    immediate sync. After each finished reel the journal is compacted to the
+    in-flight records only, so startup replays a short tail even if some
+    downloads never get uploaded.
+    """
+
+    # States that close out an entry - nothing left to recover
+    TERMINAL_STATES = ('archived', 'dropped')
+
+    def __init__(self, path, batch_size=8):
+        self.path = path
+        self.batch_size = batch_size
+        self.pending = 0
+        self.in_flight = {}  # key -> last record, kept when the journal is compacted
+        self.file = None
+
+    def replay(self):
+        """Read the journal tail and return the last record for each unfinished key"""
+        self.in_flight = {}
+        if os.path.exists(self.path):
+            good_bytes = 0
+            with open(self.path, 'rb') as f:
+                for line in f:
+                    try:
+                        if not line.endswith(b'\n'):
+                            raise ValueError('unterminated record')
+                        record = json.loads(line)
+                        if not isinstance(record, dict) or 'key' not in record:
+                            raise ValueError('malformed record')
+                    except ValueError:
+                        # Torn or corrupt write from a crash - drop it and everything after
+                        break
+                    good_bytes += len(line)
+                    if record.get('state') in self.TERMINAL_STATES:
+                        self.in_flight.pop(record['key'], None)
+                    else:
+                        self.in_flight[record['key']] = record
+
+            # Cut off the torn tail so new records start on a clean line
+            if good_bytes < os.path.getsize(self.path):
+                with open(self.path, 'r+b') as f:
+                    f.truncate(good_bytes)
+        return dict(self.in_flight)
+
+    def record(self, key, state, video=None, sync=False):
+        """Append a state transition for key, fsyncing when the batch is full or sync is set"""
+        entry = {'key': key, 'state': state, 'video': video, 'ts': time.time()}
+        if self.file is None:
+            self.file = open(self.path, 'a')
+        self.file.write(json.dumps(entry) + '\n')
+        # Always hand the record to the OS so a killed process can't lose it; only fsync is batched
+        self.file.flush()
+        self.pending += 1
+
+        if state in self.TERMINAL_STATES:
+            self.in_flight.pop(key, None)
+        else:
+            self.in_flight[key] = entry
+
+        if sync or self.pending >= self.batch_size:
+            self.sync()
+
+    def key_for_video(self, video):
+        """Find the in-flight key that was journaled for a downloaded video path"""
+        for key, record in self.in_flight.items():
+            if record.get('video') == video:
+                return key
+        return None
+
+    def sync(self):
+        """Fsync flushed records to disk"""
+        if self.file is not None and self.pending:
+            os.fsync(self.file.fileno())
+            self.pending = 0
+
+    def checkpoint(self):
+        """Compact the journal down to the last record of each in-flight key.
+
+        Callers must have durably persisted processed/failed posts first, since
+        those files become the only record of finished work.
+        """
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.pending = 0
+
+        def write_in_flight(f):
+            for record in self.in_flight.values():
+                f.write(json.dumps(record) + '\n')
+        replace_file_atomically(self.path, write_in_flight)
+
+class CycleTracer:
+    """Opt-in per-stage timing for bot cycles.
+
+    Stage timings are collected with stage()/traced() and, when a trace file
+    is configured, written as one JSON line per cycle. When disabled every
+    hook is a no-op. A cycle can additionally be wrapped in cProfile or
+    tracemalloc by passing profile_mode.
+
+    Stage times are inclusive and stages may nest (test_login runs inside
+    get_instaloader_session), so summing all stages can double count.
+    """
+
+    PROFILE_MODES = ('cprofile', 'tracemalloc')
+
+    def __init__(self, trace_file=None, profile_mode=None, profile_folder="profiles"):
+        self.trace_file = trace_file
+        self.profile_mode = profile_mode
+        self.profile_folder = profile_folder
+        self.stages = None  # stage name -> {'calls': n, 'seconds': total}
+
+    @contextmanager
+    def stage(self, name):
+        """Time the enclosed block and add it to the current cycle"""
+        if self.stages is None:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            stats = self.stages.setdefault(name, {'calls': 0, 'seconds': 0.0})
+            stats['calls'] += 1
+            stats['seconds'] += time.perf_counter() - start
+
+    def iterate(self, name, iterable):
+        """Yield from iterable, timing only the time spent fetching each item"""
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    @contextmanager
+    def cycle(self, mode):
+        """Collect stages for one bot cycle, profiling it if requested"""
+        if not self.trace_file and not self.profile_mode:
+            yield
+            return
+
+        self.stages = {}
+        started_at = datetime.now()
+        start = time.perf_counter()
+        profiler = None
+        if self.profile_mode == 'cprofile':
+            profiler = cProfile.Profile()
+            profiler.enable()
+        elif self.profile_mode == 'tracemalloc':
+            tracemalloc.start()
+
+        try:
+            yield
+        finally:
+            total = time.perf_counter() - start
+            stamp = started_at.strftime('%Y%m%d-%H%M%S')
+            if profiler is not None:
+                profiler.disable()
+                os.makedirs(self.profile_folder, exist_ok=True)
+                profile_path = os.path.join(self.profile_folder, f"cycle-{stamp}.prof")
+                profiler.dump_stats(profile_path)
+                print(f"cProfile output saved to {profile_path}")
+            elif self.profile_mode == 'tracemalloc':
+                snapshot = tracemalloc.take_snapshot()
+                current, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                os.makedirs(self.profile_folder, exist_ok=True)
+                profile_path = os.path.join(self.profile_folder, f"cycle-{stamp}-memory.txt")
+                with open(profile_path, 'w') as f:
+                    f.write(f"Current: {current / 1024:.1f}KB, peak: {peak / 1024:.1f}KB\n")
+                    for stat in snapshot.statistics('lineno')[:50]:
+                        f.write(f"{stat}\n")
+                print(f"tracemalloc output saved to {profile_path}")
+
+            if self.trace_file:
+                trace = {
+                    'started': str(started_at),
+                    'mode': mode,
+                    'total_seconds': round(total, 4),
+                    'stages': {
+                        name: {'calls': stats['calls'], 'seconds': round(stats['seconds'], 4)}
+                        for name, stats in self.stages.items()
+                    }
+                }
+                with open(self.trace_file, 'a') as f:
+                    f.write(json.dumps(trace) + '\n')
+            self.stages = None
+
+def traced(name):
+    """Decorator timing a ReelReposter method as the given stage"""
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.tracer.stage(name):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
 class ReelReposter:
-    def __init__(self):
+    def __init__(self, profile_mode=None):
         self.target_account = os.getenv('DOWNLOAD_TARGET', 'fineshytreels')
         self.download_folder = "downloads"  # Let Instaloader handle subfolders
         self.processed_folder = "processed"
         self.state_file = "bot_state.json"
         self.processed_posts_file = "processed_posts.json"
         self.failed_posts_file = "failed_posts.json"
+        self.journal_file = "repost_journal.jsonl"
         self.caption = "#fyp #viral #foryoupage"
         
+        # Optional per-cycle stage traces, e.g. CYCLE_TRACE_FILE=cycle_trace.jsonl
+        self.tracer = CycleTracer(trace_file=os.getenv('CYCLE_TRACE_FILE'), profile_mode=profile_mode)
+        
         # Mode: 'catchup' or 'monitor'
         self.mode = self.load_state()
         
@@ -54,6 +285,10 @@ class ReelReposter:
         # Track failed/skipped posts separately
         self.failed_posts = self.load_failed_posts()
         
+        # Finish any lifecycle steps interrupted by a crash
+        self.journal = RepostJournal(self.journal_file)
+        self.recover_from_journal()
+        
         # Proxy configuration
         self.proxy_url = os.getenv('PROXY_URL')
         if self.proxy_url:
@@ -68,8 +303,9 @@ class ReelReposter:
     
     def save_processed_posts(self):
         """Save list of processed posts"""
-        with open(self.processed_posts_file, 'w') as f:
-            json.dump(list(self.processed_posts), f)
+        # Atomic + fsynced: the journal is compacted on the assumption this is on disk
+        replace_file_atomically(self.processed_posts_file,
+                                lambda f: json.dump(list(self.processed_posts), f))
     
     def load_failed_posts(self):
         """Load list of posts that failed to download"""
@@ -80,8 +316,62 @@ class ReelReposter:
     
     def save_failed_posts(self):
         """Save list of failed posts"""
-        with open(self.failed_posts_file, 'w') as f:
-            json.dump(list(self.failed_posts), f)
+        replace_file_atomically(self.failed_posts_file,
+                                lambda f: json.dump(list(self.failed_posts), f))
+    
+    def recover_from_journal(self):
+        """Replay the journal tail and complete or drop interrupted reels"""
+        in_flight = self.journal.replay()
+        if not in_flight:
+            return
+        
+        print(f"Recovering {len(in_flight)} interrupted reel(s) from journal...")
+        for key, record in in_flight.items():
+            video_path = record.get('video')
+            state = record.get('state')
+            
+            if state in ('uploaded', 'recorded'):
+                # Upload went through - finish bookkeeping so it is never reposted
+                print(f"Finishing archive of uploaded reel {key}")
+                self.finalize_upload(key, video_path)
+            elif state == 'downloaded' and not (video_path and os.path.exists(video_path)):
+                print(f"Downloaded reel {key} is gone from disk, dropping from journal")
+                self.journal.record(key, 'dropped', video_path)
+            # Downloaded reels still on disk are picked up by the normal upload queue
+        
+        self.journal.checkpoint()
+    
+    def finalize_upload(self, key, video_path):
+        """Mark an uploaded reel as processed and archive it with its metadata files.
+        
+        Every step is idempotent so it can be safely re-run during recovery.
+        """
+        filename = os.path.basename(video_path)
+        
+        # Keys fall back to the filename when no shortcode is known
+        if key != filename and key not in self.processed_posts:
+            print(f"Marking shortcode {key} as processed")
+            self.processed_posts.add(key)
+            self.save_processed_posts()
+        self.journal.record(key, 'recorded', video_path)
+        
+        # Create processed folder if needed
+        os.makedirs(self.processed_folder, exist_ok=True)
+        
+        if os.path.exists(video_path):
+            shutil.move(video_path, os.path.join(self.processed_folder, filename))
+            print(f"Moved {filename} to processed folder")
+        
+        # Also move metadata files if they exist
+        video_dir = os.path.dirname(video_path)
+        base_name = filename.rsplit('.', 1)[0]
+        for ext in ['.json', '.jpg', '.txt']:
+            meta_file = os.path.join(video_dir, base_name + ext)
+            if os.path.exists(meta_file):
+                shutil.move(meta_file, os.path.join(self.processed_folder, base_name + ext))
+        
+        self.journal.record(key, 'archived', video_path)
+        self.journal.checkpoint()
     
     def get_proxy_dict(self):
         """Get proxy dictionary for requests"""
@@ -92,6 +382,7 @@ class ReelReposter:
             }
         return None
     
+    @traced('get_instaloader_session')
     def get_instaloader_session(self, try_different_proxy=False):
         """Get Instaloader with proxy and session management"""
         L = instaloader.Instaloader(
@@ -135,7 +426,8 @@ class ReelReposter:
                 
                 # Test if session is still valid
                 try:
-                    L.context.test_login()
+                    with self.tracer.stage('test_login'):
+                        L.context.test_login()
                     print("Session is valid!")
                     return L
                 except:
@@ -173,6 +465,7 @@ class ReelReposter:
         with open(self.state_file, 'w') as f:
             json.dump({'mode': mode, 'last_update': str(datetime.now())}, f)
     
+    @traced('scan_folders')
     def find_all_mp4_files(self):
         """Find all MP4 files recursively in downloads and processed folders"""
         all_files = []
@@ -193,6 +486,7 @@ class ReelReposter:
         
         return all_files
     
+    @traced('scan_folders')
     def get_unprocessed_videos(self, limit=None):
         """Find videos that haven't been uploaded yet"""
         videos = []
@@ -241,14 +535,15 @@ class ReelReposter:
         print("Checking for new reels...")
         
         # Count MP4 files before download
-        files_before = len(self.find_all_mp4_files())
-        print(f"MP4 files before download: {files_before}")
+        files_before = set(self.find_all_mp4_files())
+        print(f"MP4 files before download: {len(files_before)}")
         
         try:
-            profile = instaloader.Profile.from_username(L.context, self.target_account)
+            with self.tracer.stage('get_profile'):
+                profile = instaloader.Profile.from_username(L.context, self.target_account)
             
             # Get the most recent post
-            for post in profile.get_posts():
+            for post in self.tracer.iterate('get_posts', profile.get_posts()):
                 if post.is_video and post.typename == 'GraphVideo':
                     # Check if we've already processed this post
                     if post.shortcode in self.processed_posts:
@@ -262,14 +557,18 @@ class ReelReposter:
                     
                     # Download the post
                     try:
-                        L.download_post(post, target=profile.username)
+                        with self.tracer.stage('download_post'):
+                            L.download_post(post, target=profile.username)
                         
                         # Check if a new file was created
-                        files_after = len(self.find_all_mp4_files())
-                        print(f"MP4 files after download: {files_after}")
+                        files_after = set(self.find_all_mp4_files())
+                        print(f"MP4 files after download: {len(files_after)}")
                         
-                        if files_after > files_before:
+                        new_files = files_after - files_before
+                        if new_files:
                             print(f"New reel downloaded successfully!")
+                            # Sync now - this record is the only shortcode-to-path mapping
+                            self.journal.record(post.shortcode, 'downloaded', sorted(new_files)[0], sync=True)
                             # Don't mark as processed here - only after upload
                             return True
                         else:
@@ -337,12 +636,13 @@ class ReelReposter:
             client = UploadPostClient(api_key=api_key)
             
             # Upload the video
-            response = client.upload_video(
-                video_path=video_path,
-                title=self.caption,  # "#fyp #viral"
-                user=managed_user,
-                platforms=["instagram"]  # Just Instagram for now
-            )
+            with self.tracer.stage('upload_video'):
+                response = client.upload_video(
+                    video_path=video_path,
+                    title=self.caption,  # "#fyp #viral"
+                    user=managed_user,
+                    platforms=["instagram"]  # Just Instagram for now
+                )
             
             print(f"\nFull Upload Response:")
             print(json.dumps(response, indent=2))
@@ -352,31 +652,16 @@ class ReelReposter:
                 # Check if Instagram upload actually succeeded
                 instagram_result = response.get('results', {}).get('instagram', {})
                 if instagram_result.get('success', False):
-                    # Actually successful - move to processed
-                    filename = os.path.basename(video_path)
-                    dest_path = os.path.join(self.processed_folder, filename)
-                    
-                    # Create processed folder if needed
-                    os.makedirs(self.processed_folder, exist_ok=True)
-                    
-                    # Move the file
-                    shutil.move(video_path, dest_path)
-                    print(f"✓ Upload SUCCESSFUL! Moved {filename} to processed folder")
+                    print(f"✓ Upload SUCCESSFUL!")
                     
-                    # Extract shortcode and mark as processed
-                    shortcode = self.extract_shortcode_from_path(video_path)
-                    if shortcode:
-                        print(f"Marking shortcode {shortcode} as processed")
-                        self.processed_posts.add(shortcode)
-                        self.save_processed_posts()
+                    # Prefer the shortcode journaled at download time
+                    key = (self.journal.key_for_video(video_path)
+                           or self.extract_shortcode_from_path(video_path)
+                           or os.path.basename(video_path))
                     
-                    # Also move metadata files if they exist
-                    video_dir = os.path.dirname(video_path)
-                    base_name = filename.rsplit('.', 1)[0]
-                    for ext in ['.json', '.jpg', '.txt']:
-                        meta_file = os.path.join(video_dir, base_name + ext)
-                        if os.path.exists(meta_file):
-                            shutil.move(meta_file, os.path.join(self.processed_folder, base_name + ext))
+                    # Sync before anything else so a crash can't lead to a repost
+                    self.journal.record(key, 'uploaded', video_path, sync=True)
+                    self.finalize_upload(key, video_path)
                     
                     print(f"Upload completed at {datetime.now()}")
                     return True
@@ -418,7 +703,8 @@ class ReelReposter:
             print(f"Failed/skipped {len(self.failed_posts)} posts")
             
             try:
-                profile = instaloader.Profile.from_username(L.context, self.target_account)
+                with self.tracer.stage('get_profile'):
+                    profile = instaloader.Profile.from_username(L.context, self.target_account)
                 total_posts = profile.mediacount
                 print(f"Profile has {total_posts} total posts")
                 
@@ -428,7 +714,7 @@ class ReelReposter:
                 posts_skipped_failed = 0
                 
                 # Try to download any reel we don't have
-                for post in profile.get_posts():
+                for post in self.tracer.iterate('get_posts', profile.get_posts()):
                     if post.is_video and post.typename == 'GraphVideo':
                         posts_checked += 1
                         
@@ -450,13 +736,18 @@ class ReelReposter:
                             print(f"Post date: {post.date_local}")
                             print(f"Attempting download (checked {posts_checked} posts so far)...")
                             
-                            L.download_post(post, target=profile.username)
+                            with self.tracer.stage('download_post'):
+                                L.download_post(post, target=profile.username)
                             
                             # Check if we have more videos now
                             videos_after = self.get_unprocessed_videos()
                             
                             if len(videos_after) > len(videos_before):
                                 print(f"✓ Successfully downloaded NEW reel: {post.shortcode}")
+                                new_videos = set(videos_after) - set(videos_before)
+                                if new_videos:
+                                    # Sync now - this record is the only shortcode-to-path mapping
+                                    self.journal.record(post.shortcode, 'downloaded', sorted(new_videos)[0], sync=True)
                                 # Don't mark as processed yet - only after successful upload
                                 return True
                             else:
@@ -517,7 +808,10 @@ class ReelReposter:
         return False
     
     def catchup_mode(self):
-        """Download and post one reel at a time with 30 min intervals"""
+        """Download and post one reel at a time with 30 min intervals.
+        
+        Returns the number of seconds to wait before the next cycle, if any.
+        """
         print("\n" + "="*50)
         print("Running in CATCHUP mode - download, post, wait 30 mins, repeat")
         print(f"Already successfully posted: {len(self.processed_posts)} videos")
@@ -535,11 +829,10 @@ class ReelReposter:
             if self.upload_video(unprocessed[0]):
                 print("\n✓ Upload successful, waiting 30 minutes before next cycle...")
                 print(f"Progress: {len(self.processed_posts)} posts completed")
-                time.sleep(1800)  # 30 minutes
+                return 1800  # 30 minutes
             else:
                 print("\n✗ Upload failed! Waiting 30 minutes before retry...")
-                time.sleep(1800)  # Still wait 30 mins even on failure
-            return
+                return 1800  # Still wait 30 mins even on failure
         
         # Download one new reel immediately
         print("No unprocessed videos found, downloading next reel...")
@@ -555,10 +848,10 @@ class ReelReposter:
                 if self.upload_video(videos[0]):
                     print("\n✓ Upload successful, waiting 30 minutes before next download...")
                     print(f"Progress: {len(self.processed_posts)} posts completed")
-                    time.sleep(1800)  # 30 minutes
+                    return 1800  # 30 minutes
                 else:
                     print("\n✗ Upload failed, waiting 30 minutes before retry...")
-                    time.sleep(1800)  # 30 minutes
+                    return 1800  # 30 minutes
             else:
                 print("ERROR: Downloaded but no video found in folder!")
                 # Show what's in the downloads directory
@@ -584,7 +877,7 @@ class ReelReposter:
             else:
                 print(f"Still have {len(unprocessed)} videos to process")
                 # Wait 30 minutes before checking again
-                time.sleep(1800)
+                return 1800
     
     def monitor_mode(self):
         """Check for new reels and post immediately"""
@@ -603,12 +896,18 @@ class ReelReposter:
     
     def run_once(self):
         """Run one cycle based on current mode"""
-        self.setup_folders()
+        wait_seconds = None
+        with self.tracer.cycle(self.mode):
+            self.setup_folders()
+            
+            if self.mode == 'catchup':
+                wait_seconds = self.catchup_mode()
+            else:
+                self.monitor_mode()
         
-        if self.mode == 'catchup':
-            self.catchup_mode()
-        else:
-            self.monitor_mode()
+        # Wait outside the traced cycle so traces and profiles only cover real work
+        if wait_seconds:
+            time.sleep(wait_seconds)
     
     def schedule_random_hourly(self):
         """Schedule uploads at random times each hour"""
@@ -646,7 +945,8 @@ def main():
     
     # Check for reset command
     import sys
-    if len(sys.argv) > 1 and sys.argv[1] == 'reset':
+    args = sys.argv[1:]
+    if 'reset' in args:
         print("\nRESETTING BOT STATE...")
         if os.path.exists('processed_posts.json'):
             os.remove('processed_posts.json')
@@ -657,9 +957,25 @@ def main():
         if os.path.exists('failed_posts.json'):
             os.remove('failed_posts.json')
             print("✓ Cleared failed posts tracking")
+        if os.path.exists('repost_journal.jsonl'):
+            os.remove('repost_journal.jsonl')
+            print("✓ Cleared lifecycle journal")
         print("Bot reset complete! Starting fresh...\n")
     
-    bot = ReelReposter()
+    # Check for profiling flag: --profile (cProfile) or --profile=tracemalloc
+    profile_mode = None
+    for arg in args:
+        if arg == '--profile':
+            profile_mode = 'cprofile'
+        elif arg.startswith('--profile='):
+            profile_mode = arg.split('=', 1)[1]
+    if profile_mode and profile_mode not in CycleTracer.PROFILE_MODES:
+        print(f"Unknown profile mode '{profile_mode}', expected one of {CycleTracer.PROFILE_MODES}")
+        sys.exit(1)
+    
+    bot = ReelReposter(profile_mode=profile_mode)
+    if profile_mode:
+        print(f"Profiling every cycle with {profile_mode}, output in {bot.tracer.profile_folder}/")
     
     # Check if we're in catchup mode
     if bot.mode == 'catchup':